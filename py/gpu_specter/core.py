@@ -2,12 +2,40 @@
 Core scaffolding for divide and conquer extraction algorithm
 """
 
+import os
 import sys
+import ctypes
+import functools
+import itertools
+import concurrent.futures
 
 import numpy as np
 
 try:
     import cupy as cp
+    #- One thread per element of the stacked patch results; see _scatter_patches
+    _scatter_patches_kernel = cp.ElementwiseKernel(
+        'raw T src, raw int32 istart, raw int32 jstart, raw int32 keep, '
+        'int32 nspec, int32 nmid, int32 nwavestep, int32 nwaveout',
+        'raw T dst',
+        '''
+        int j = i % nwavestep;
+        int k = (i / nwavestep) % nmid;
+        int s = (i / (nwavestep * nmid)) % nspec;
+        int p = i / (nwavestep * nmid * nspec);
+        if (j < keep[p]) {
+            dst[((istart[p] + s) * nmid + k) * nwaveout + jstart[p] + j] = src[i];
+        }
+        ''',
+        'scatter_patches')
+    #- Convert flux and ivar from per-bin to per-Angstrom and derive the
+    #- ivar == 0 mask in a single pass; the bin width is uniform so it is
+    #- passed as the scalars 1/dw and dw**2
+    _finalize_bundle = cp.ElementwiseKernel(
+        'T f, T v, T inv_dw, T dw2',
+        'T fo, T vo, M mask',
+        'fo = f * inv_dw; vo = v * dw2; mask = (vo == 0)',
+        'finalize_bundle')
 except ImportError:
     pass
 
@@ -15,8 +43,28 @@ from gpu_specter.util import get_logger
 from gpu_specter.util import get_array_module
 from gpu_specter.util import Timer
 from gpu_specter.util import gather_ndarray
+from gpu_specter.util import bcast_shared_ndarray
+from gpu_specter.util import bcast_tables
+from gpu_specter.util import nvtx_range_push, nvtx_range_pop, NvtxRange
+
+#- Set GPU_SPECTER_CUDA_AWARE_MPI=1 if the MPI library accepts device buffers,
+#- so that GPU patch results are gathered without a round trip through the host
+_CUDA_AWARE_MPI = os.getenv('GPU_SPECTER_CUDA_AWARE_MPI', '0') == '1'
+
+#- Extraction backends are imported once here rather than on every call;
+#- the gpu backend is only available if cupy and numba.cuda are
+from gpu_specter.extract import cpu as _cpu_backend
+_backends = dict(cpu=_cpu_backend)
+try:
+    from gpu_specter.extract import gpu as _gpu_backend
+    _backends['gpu'] = _gpu_backend
+except ImportError:
+    pass
 
 class Patch(object):
+    __slots__ = ('ispec', 'iwave', 'nspectra_per_patch', 'nwavestep', 'wavepad', 'bspecmin',
+                 'specslice', 'waveslice', 'keepslice', 'nwave', 'bundlesize', 'ndiag')
+
     def __init__(self, ispec, iwave, bspecmin, nspectra_per_patch, nwavestep, wavepad, nwave,
         bundlesize, ndiag):
         """Convenience data wrapper for divide and conquer extraction patches
@@ -66,51 +114,275 @@ class Patch(object):
         self.ndiag = ndiag
 
 
-def assemble_bundle_patches(rankresults):
+def _pinned_empty(shape, dtype=np.float64):
+    """Returns an uninitialized host ndarray backed by pinned memory
     """
-    Assembles bundle patches into output arrays
+    count = int(np.prod(shape))
+    mem = cp.cuda.alloc_pinned_memory(count * np.dtype(dtype).itemsize)
+    return np.frombuffer(mem, dtype=dtype, count=count).reshape(shape)
+
+
+def _to_device_pinned(arr, stream):
+    """Asynchronously copy a host array to the device via a pinned staging buffer
 
     Args:
-        rankresults: list of lists containing individual patch extraction results
+        arr: host ndarray to copy
+        stream: cupy stream to issue the copy on
 
     Returns:
-        (spexflux, specivar, Rdiags) tuple
+        (device, staging) tuple; the pinned staging array must be kept alive
+        until `stream` has been synchronized
     """
+    staging = _pinned_empty(arr.shape, dtype=arr.dtype)
+    staging[...] = arr
+    device = cp.empty(arr.shape, dtype=arr.dtype)
+    device.set(staging, stream=stream)
+    return device, staging
 
-    #- flatten list of lists into single list
-    allresults = list()
-    for rr in rankresults:
-        allresults.extend(rr)
 
-    #- peak at result to get bundle params
-    patch = allresults[0][0]
-    nwave = patch.nwave
-    bundlesize = patch.bundlesize
-    ndiag = patch.ndiag
+#- Host arrays larger than this are moved to the device with managed memory
+_MANAGED_MIN_NBYTES = 256 * 2**20
+
+
+def _to_device_managed(arr):
+    """Copy a host array into CUDA managed memory
+
+    The copy is written through a host view of the managed allocation, so
+    no device transfer happens up front; the driver migrates pages to the
+    device on first touch by a kernel.
+
+    Args:
+        arr: host ndarray to copy
+
+    Returns:
+        cupy ndarray backed by managed memory
+    """
+    memptr = cp.cuda.malloc_managed(arr.nbytes)
+    buf = (ctypes.c_byte * arr.nbytes).from_address(memptr.ptr)
+    np.frombuffer(buf, dtype=arr.dtype).reshape(arr.shape)[...] = arr
+    return cp.ndarray(arr.shape, dtype=arr.dtype, memptr=memptr)
+
+
+def _to_device(arr, stream):
+    """Move a host array to the device, asynchronously on `stream` if staged
+
+    Arrays larger than _MANAGED_MIN_NBYTES use managed memory on devices
+    that support page migration (compute capability 6.0+), otherwise they
+    are staged through pinned memory (see _to_device_pinned).
+
+    Args:
+        arr: host ndarray to copy
+        stream: cupy stream to issue a staged copy on
+
+    Returns:
+        (device, staging) tuple; staging is None for managed memory
+    """
+    if arr.nbytes > _MANAGED_MIN_NBYTES and int(cp.cuda.Device().compute_capability) >= 60:
+        return _to_device_managed(arr), None
+    return _to_device_pinned(arr, stream)
+
+
+def _warmup_ex2d_padded(spots, corners, nspec, nwave, wavepad, bundlesize):
+    """Run one throwaway GPU patch extraction to compile its kernels
+
+    The extraction uses a small synthetic image sized to fit the spots of
+    the first patch, so it can run before the real image reaches the device
+    and the kernel compilation overlaps with that transfer.
+
+    Args:
+        spots: array[nspec, nwave, ny, nx] pre-evaluated PSF spots
+        corners: tuple of arrays xcorners[nspec, nwave], ycorners[nspec, nwave]
+        nspec: number of spectra per patch
+        nwave: number of wavelengths per patch
+        wavepad: number of extra wave bins to extract (and discard) on each end
+        bundlesize: size of fiber bundles
+    """
+    nspec = min(nspec, spots.shape[0])
+    spots = spots[:, :nwave+2*wavepad]
+    xc, yc = (c[:, :nwave+2*wavepad] for c in corners)
+    xc, yc = xc - xc.min(), yc - yc.min()
+    ny, nx = spots.shape[2:4]
+    shape = (int(yc.max()) + 2*ny, int(xc.max()) + 2*nx)
+    _backends['gpu'].ex2d_padded(cp.zeros(shape), cp.ones(shape),
+                                 0, nspec, wavepad, nwave,
+                                 spots, (xc, yc), wavepad, bundlesize=bundlesize)
+
+
+def _scatter_patches(dst, src, istart, jstart, keep):
+    """Scatter stacked patch results into a bundle output array
+
+    Args:
+        dst: C-contiguous output array[bundlesize, ..., nwave]
+        src: C-contiguous stacked patch results array[npatch, nspec, ..., nwavestep]
+        istart: int32 array[npatch] of first spectrum index of each patch in dst
+        jstart: int32 array[npatch] of first wavelength index of each patch in dst
+        keep: int32 array[npatch] of number of wavelength bins to keep from each patch
+
+    Any axes between the spectrum and wavelength axes (e.g. Rdiags diagonals)
+    are copied as is.
+    """
+    xp = get_array_module(dst)
+    npatch, nspec = src.shape[0:2]
+    nwavestep = src.shape[-1]
+    nwaveout = dst.shape[-1]
+    nmid = int(np.prod(src.shape[2:-1]))
+
+    if xp is np:
+        #- Flat destination index of every source element, same as the kernel
+        p = np.arange(npatch).reshape(-1, 1, 1, 1)
+        s = np.arange(nspec).reshape(1, -1, 1, 1)
+        k = np.arange(nmid).reshape(1, 1, -1, 1)
+        j = np.arange(nwavestep).reshape(1, 1, 1, -1)
+        index = ((istart[p] + s) * nmid + k) * nwaveout + jstart[p] + j
+        mask = np.broadcast_to(j < keep[p], index.shape)
+        np.put(dst, index[mask], src.reshape(index.shape)[mask])
+    else:
+        _scatter_patches_kernel(src, istart, jstart, keep,
+                                nspec, nmid, nwavestep, nwaveout,
+                                dst, size=src.size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_patch_layout(bundlesize, nspectra_per_patch, nwavestep, wavepad, nwave):
+    """
+    Returns the layout of the patches of a bundle as int32 arrays
+
+    Args:
+        bundlesize: size of fiber bundles
+        nspectra_per_patch: number of spectra to extract (not including padding)
+        nwavestep: number of wavelengths to extract (not including padding)
+        wavepad: number of extra wave bins to extract (and discard) on each end
+        nwave: number of wavelength bins in for entire bundle
+
+    Returns:
+        (ispec, iwave, nwavekeep) tuple of arrays[npatch] with the starting
+        spectrum index relative to the start of the bundle, the starting
+        wavelength index in the padded wavelength grid, and the number of
+        wavelength bins to keep from each patch. Patches are ordered the same
+        way as the Patch objects of a bundle: by spectrum, then wavelength.
+
+    The layout only depends on the arguments, not on which bundle it is for,
+    so it is cached and the returned arrays are read-only.
+    """
+    ispec = np.arange(0, bundlesize, nspectra_per_patch, dtype=np.int32)
+    iwave = np.arange(wavepad, wavepad+nwave, nwavestep, dtype=np.int32)
+    ispec, iwave = np.repeat(ispec, len(iwave)), np.tile(iwave, len(ispec))
+    nwavekeep = np.minimum(nwavestep, nwave - (iwave - wavepad)).astype(np.int32)
+    for x in (ispec, iwave, nwavekeep):
+        x.flags.writeable = False
+    return ispec, iwave, nwavekeep
+
+
+def get_wavelength_grid(wmin, wmax, dw, wavepad, nwavestep):
+    """
+    Returns the padded and unpadded wavelength grids to extract
+
+    Args:
+        wmin: first wavelength to extract
+        wmax: last wavelength to extract
+        dw: wavelength bin width
+        wavepad: number of extra wave bins to extract (and discard) on each end
+        nwavestep: number of wavelength bins per patch
+
+    Returns:
+        (fullwave, wave) tuple; wave is equivalent to
+        np.arange(wmin, wmax + 0.5*dw, dw) and fullwave pads it with wavepad
+        bins on each end plus an extra nwavestep bins to allow coverage for a
+        final partial patch. wave is a view into fullwave.
+    """
+    nwave = int(np.ceil((wmax + 0.5*dw - wmin) / dw))
+    #- Build the grid in place in a single allocation
+    fullwave = np.arange(-wavepad, nwave + wavepad + nwavestep, dtype=np.float64)
+    fullwave *= dw
+    fullwave += wmin
+    return fullwave, fullwave[wavepad:wavepad+nwave]
+
+
+def _assemble_bundle(rankresults, istart, jstart, keep, bundlesize, nwave, ndiag,
+                     dtype=np.float32):
+    """
+    Scatters stacked patch results into bundle output arrays
+
+    Args:
+        rankresults: list of dicts of stacked patch extraction results
+        istart: int32 array[npatch] of first spectrum index of each patch in the bundle
+        jstart: int32 array[npatch] of first wavelength index of each patch in the bundle
+        keep: int32 array[npatch] of number of wavelength bins to keep from each patch
+        bundlesize: size of fiber bundles
+        nwave: number of wavelength bins in for entire bundle
+        ndiag: number of diagonal elements to keep in the resolution matrix
+
+    Options:
+        dtype: dtype of the assembled Rdiags
+
+    The patches described by istart, jstart, and keep are in the order of the
+    concatenation of rankresults.
+
+    Returns:
+        (spexflux, specivar, Rdiags) tuple
+    """
+    xp = get_array_module(rankresults[0]['flux'])
+    nspectra_per_patch = rankresults[0]['flux'].shape[1]
 
-    xp = get_array_module(allresults[0][1]['flux'])
+    #- Patches don't overlap, so if they cover the whole bundle every output
+    #- element is written below and there is no need to zero fill
+    full_coverage = np.sum(keep) * nspectra_per_patch == bundlesize * nwave
+    alloc = xp.empty if full_coverage else xp.zeros
 
     #- Allocate output arrays to fill
-    specflux = xp.zeros((bundlesize, nwave))
-    specivar = xp.zeros((bundlesize, nwave))
-    Rdiags = xp.zeros((bundlesize, 2*ndiag+1, nwave))
+    specflux = alloc((bundlesize, nwave))
+    specivar = alloc((bundlesize, nwave))
+    Rdiags = alloc((bundlesize, 2*ndiag+1, nwave), dtype=dtype)
 
-    #- Now put these into the final arrays
-    for patch, result in allresults:
-        fx = result['flux']
-        fxivar = result['ivar']
-        xRdiags = result['Rdiags']
+    #- Move the layout to the device (if needed) in a single transfer
+    istart, jstart, keep = xp.asarray(np.array([istart, jstart, keep], dtype=np.int32))
 
-        #- put the extracted patch into the output arrays
-        specflux[patch.specslice, patch.waveslice] = fx[:, patch.keepslice]
-        specivar[patch.specslice, patch.waveslice] = fxivar[:, patch.keepslice]
-        Rdiags[patch.specslice, :, patch.waveslice] = xRdiags[:, :, patch.keepslice]
+    #- Now put these into the final arrays, one scatter per output
+    for key, out in (('flux', specflux), ('ivar', specivar), ('Rdiags', Rdiags)):
+        if len(rankresults) == 1:
+            src = rankresults[0][key]
+        else:
+            src = xp.concatenate([results[key] for results in rankresults])
+        _scatter_patches(out, src.astype(out.dtype, copy=False), istart, jstart, keep)
 
     return specflux, specivar, Rdiags
 
 
+def assemble_bundle_patches(rankresults, dtype=np.float32):
+    """
+    Assembles bundle patches into output arrays
+
+    Args:
+        rankresults: list of (patches, results) tuples, one per rank, where
+            results is a dict of patch extraction results stacked along the
+            first axis in the same order as patches (see ex2d_padded_batched)
+
+    Options:
+        dtype: dtype of the assembled Rdiags
+
+    Returns:
+        (spexflux, specivar, Rdiags) tuple
+    """
+
+    #- flatten list of lists into single list
+    patches = list(itertools.chain.from_iterable(
+        rankpatches for rankpatches, results in rankresults))
+
+    #- peak at result to get bundle params
+    patch = patches[0]
+
+    #- Where each patch goes in the output arrays
+    istart = np.array([patch.specslice.start for patch in patches], dtype=np.int32)
+    jstart = np.array([patch.waveslice.start for patch in patches], dtype=np.int32)
+    keep = np.array([patch.keepslice.stop for patch in patches], dtype=np.int32)
+
+    return _assemble_bundle([results for rankpatches, results in rankresults],
+                            istart, jstart, keep,
+                            patch.bundlesize, patch.nwave, patch.ndiag, dtype=dtype)
+
+
 def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=25, nsubbundles=1,
-    nwavestep=50, wavepad=10, comm=None, gpu=None, loglevel=None):
+    nwavestep=50, wavepad=10, comm=None, gpu=None, loglevel=None, spots=None, corners=None):
     """
     Extract 1D spectra from a single bundle of a 2D image.
 
@@ -132,9 +404,13 @@ def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=2
         size: number of mpi processes (no mpi: 1)
         gpu: use GPU for extraction (not yet implemented)
         loglevel: log print level
+        spots: precomputed PSF spots for the spectra in this bundle (see get_spots)
+        corners: precomputed PSF spot corners matching spots
 
     Returns:
-        bundle: (flux, ivar, R) tuple
+        bundle: (flux, ivar, R) tuple; these are device arrays when using
+            a GPU without an MPI comm or with a CUDA-aware MPI, otherwise
+            host arrays
 
     """
     timer = Timer()
@@ -149,12 +425,9 @@ def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=2
     log = get_logger(loglevel)
 
     #- Extracting on CPU or GPU?
-    if gpu:
-        from gpu_specter.extract.gpu import \
-                get_spots, ex2d_padded
-    else:
-        from gpu_specter.extract.cpu import \
-                get_spots, ex2d_padded
+    backend = _backends['gpu' if gpu else 'cpu']
+    device_id = cp.cuda.runtime.getDevice() if gpu else -1
+    get_spots, ex2d_padded_batched = backend.get_spots, backend.ex2d_padded_batched
 
     nwave = len(wave)
     ndiag = psf['PSF'].meta['HSIZEY']
@@ -162,11 +435,9 @@ def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=2
     timer.split('init')
 
     #- Cache PSF spots for all wavelengths for spectra in this bundle
-    if gpu:
-        cp.cuda.nvtx.RangePush('get_spots')
-    spots, corners = get_spots(bspecmin, bundlesize, fullwave, psf)
-    if gpu:
-        cp.cuda.nvtx.RangePop()
+    if spots is None:
+        with NvtxRange('get_spots'):
+            spots, corners = get_spots(bspecmin, bundlesize, fullwave, psf)
 
     timer.split('spots/corners')
 
@@ -174,89 +445,67 @@ def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=2
     spot_nx, spot_ny = spots.shape[2:4]
 
     #- Organize what sub-bundle patches to extract
-    patches = list()
     nspectra_per_patch = bundlesize // nsubbundles
-    for ispec in range(bspecmin, bspecmin+bundlesize, nspectra_per_patch):
-        for iwave in range(wavepad, wavepad+nwave, nwavestep):
-            patch = Patch(ispec, iwave, bspecmin,
-                          nspectra_per_patch, nwavestep, wavepad,
-                          nwave, bundlesize, ndiag)
-            patches.append(patch)
+    patchspec, patchwave, patchkeep = get_patch_layout(
+        bundlesize, nspectra_per_patch, nwavestep, wavepad, nwave)
+    npatch = len(patchspec)
 
     if rank == 0:
-        log.info(f'Dividing {len(patches)} patches between {size} ranks')
+        log.info(f'Dividing {npatch} patches between {size} ranks')
 
     timer.split('organize patches')
 
-    #- place to keep extraction patch results before assembling in rank 0
-    results = list()
-    for patch in patches[rank::size]:
-
-        log.debug(f'rank={rank}, ispec={patch.ispec}, iwave={patch.iwave}')
+    #- Always extract the same patch size (more efficient for GPU
+    #- memory transfer) then decide post-facto whether to keep it all
+    ispec = patchspec[rank::size]
+    iwave = patchwave[rank::size]
 
-        #- Always extract the same patch size (more efficient for GPU
-        #- memory transfer) then decide post-facto whether to keep it all
-
-        if gpu:
-            cp.cuda.nvtx.RangePush('ex2d_padded')
-
-        result = ex2d_padded(image, imageivar,
-                             patch.ispec-bspecmin, patch.nspectra_per_patch,
-                             patch.iwave, patch.nwavestep,
-                             spots, corners,
-                             wavepad=patch.wavepad,
-                             bundlesize=bundlesize)
-        if gpu:
-            cp.cuda.nvtx.RangePop()
+    log.debug(f'rank={rank}, ispec={ispec}, iwave={iwave}')
 
-        results.append( (patch, result) )
+    with NvtxRange('ex2d_padded'):
+        results = ex2d_padded_batched(image, imageivar,
+                                      ispec, iwave,
+                                      nspectra_per_patch, nwavestep,
+                                      spots, corners,
+                                      wavepad=wavepad,
+                                      bundlesize=bundlesize)
 
     timer.split('extracted patches')
 
     if comm is not None:
-        if gpu:
+        arrays = [results['flux'], results['ivar'], results['Rdiags']]
+        streams = [None, None, None]
+        if gpu and not _CUDA_AWARE_MPI:
             # If we have gpu and an MPI comm for this bundle, transfer data
-            # back to host before assembling the patches
-            patches = []
-            flux = []
-            fluxivar = []
-            resolution = []
-            for patch, results in results:
-                patches.append(patch)
-                flux.append(results['flux'])
-                fluxivar.append(results['ivar'])
-                resolution.append(results['Rdiags'])
-
-            # transfer to host in 3 chunks
-            cp.cuda.nvtx.RangePush('copy bundle results to host')
-            device_id = cp.cuda.runtime.getDevice()
+            # back to host before assembling the patches, unless MPI can
+            # gather the device buffers directly. Each array is
+            # copied on its own stream into pinned memory so that the copies
+            # overlap each other and the gathers below.
+            nvtx_range_push('copy bundle results to host')
             log.info(f'Rank {rank}: Moving bundle {bspecmin} patches to host from device {device_id}')
-            flux = cp.asnumpy(cp.array(flux, dtype=cp.float64))
-            fluxivar = cp.asnumpy(cp.array(fluxivar, dtype=cp.float64))
-            resolution = cp.asnumpy(cp.array(resolution, dtype=cp.float64))
-            cp.cuda.nvtx.RangePop()
+            ready = cp.cuda.get_current_stream().record()
+            for i, x in enumerate(arrays):
+                streams[i] = cp.cuda.Stream(non_blocking=True)
+                streams[i].wait_event(ready)
+                arrays[i] = x.get(stream=streams[i], out=_pinned_empty(x.shape, dtype=x.dtype))
+            nvtx_range_pop()
+
+        # gather the contiguous patch result buffers to root MPI rank
+        for i, stream in enumerate(streams):
+            if stream is not None:
+                stream.synchronize()
+            arrays[i] = gather_ndarray(arrays[i], comm, root=0)
+        flux, fluxivar, resolution = arrays
 
-            # gather to root MPI rank
-            patches = comm.gather(patches, root=0)
-            flux = gather_ndarray(flux, comm, root=0)
-            fluxivar = gather_ndarray(fluxivar, comm, root=0)
-            resolution = gather_ndarray(resolution, comm, root=0)
-
-            if rank == 0:
-                # unpack patches
-                patches = [patch for rankpatches in patches for patch in rankpatches]
-                # repack everything
-                rankresults = [
-                    zip(patches, 
-                        map(lambda x: dict(flux=x[0], ivar=x[1], Rdiags=x[2]), 
-                            zip(flux, fluxivar, resolution)
-                        )
-                    )
-                ]
-        else:
-            rankresults = comm.gather(results, root=0)
+        if rank == 0:
+            # every rank builds the same patch layout and extracts
+            # patches[rank::size], so root already knows the gathered order
+            order = np.concatenate([np.arange(npatch)[r::size] for r in range(size)])
+            # repack everything
+            rankresults = [dict(flux=flux, ivar=fluxivar, Rdiags=resolution),]
     else:
         # this is fine for GPU w/out MPI comm
+        order = np.arange(npatch)
         rankresults = [results,]
 
     timer.split('gathered patches')
@@ -264,18 +513,13 @@ def extract_bundle(image, imageivar, psf, wave, fullwave, bspecmin, bundlesize=2
     bundle = None
     if rank == 0:
         if gpu:
-            cp.cuda.nvtx.RangePush('assemble patches on device')
-            device_id = cp.cuda.runtime.getDevice()
+            nvtx_range_push('assemble patches on device')
             log.info(f'Rank {rank}: Assembling bundle {bspecmin} patches on device {device_id}')
-        bundle = assemble_bundle_patches(rankresults)
+        bundle = _assemble_bundle(rankresults,
+                                  patchspec[order], patchwave[order] - wavepad, patchkeep[order],
+                                  bundlesize, nwave, ndiag)
         if gpu:
-            cp.cuda.nvtx.RangePop()
-            if comm is None:
-                cp.cuda.nvtx.RangePush('copy bundle results to host')
-                device_id = cp.cuda.runtime.getDevice()
-                log.info(f'Rank {rank}: Moving bundle {bspecmin} to host from device {device_id}')
-                bundle = tuple(cp.asnumpy(x) for x in bundle)
-                cp.cuda.nvtx.RangePop()
+            nvtx_range_pop()
         timer.split('assembled patches')
         timer.log_splits(log)
     return bundle
@@ -320,6 +564,15 @@ def extract_frame(img, psf, bundlesize, specmin, nspec, wavelength=None, nwavest
         device_id = rank % device_count
         cp.cuda.Device(device_id).use()
 
+        #- Keep cached device and pinned memory for reuse between bundles, but
+        #- release whatever a previous frame left behind and bound the pool
+        #- (unless the user already did with CUPY_GPU_MEMORY_LIMIT)
+        mempool = cp.get_default_memory_pool()
+        mempool.free_all_blocks()
+        cp.get_default_pinned_memory_pool().free_all_blocks()
+        if os.getenv('CUPY_GPU_MEMORY_LIMIT') is None:
+            mempool.set_limit(fraction=0.9)
+
         #- Divide mpi ranks evenly among gpus
         device_size = size // device_count
         bundle_rank = rank // device_count
@@ -349,23 +602,36 @@ def extract_frame(img, psf, bundlesize, specmin, nspec, wavelength=None, nwavest
         imgpixels = img['image']
         imgivar = img['ivar']
 
-    #- If using MPI, broadcast image, ivar, and psf to all ranks
+    #- If using MPI, broadcast image, ivar, and psf to all ranks. With MPI-3,
+    #- the ranks on a node share a single copy of the image and ivar.
+    imgwins = list()
     if comm is not None:
+        from mpi4py import MPI
         if rank == 0:
             log.info('Broadcasting inputs to other MPI ranks')
-        imgpixels = comm.bcast(imgpixels, root=0)
-        imgivar = comm.bcast(imgivar, root=0)
-        psf = comm.bcast(psf, root=0)
+        if MPI.Get_version() >= (3, 0):
+            imgpixels, win = bcast_shared_ndarray(imgpixels, comm, root=0)
+            imgwins.append(win)
+            imgivar, win = bcast_shared_ndarray(imgivar, comm, root=0)
+            imgwins.append(win)
+        else:
+            imgpixels = comm.bcast(imgpixels, root=0)
+            imgivar = comm.bcast(imgivar, root=0)
+        psf = bcast_tables(psf, comm, root=0)
 
     #- If using GPU, move image and ivar to device
     #- TODO: is there a way for ranks to share a pointer to device memory?
     if gpu:
-        cp.cuda.nvtx.RangePush('copy imgpixels, imgivar to device')
-        device_id = cp.cuda.runtime.getDevice()
+        nvtx_range_push('copy imgpixels, imgivar to device')
         log.info(f'Rank {rank}: Moving image data to device {device_id}')
-        imgpixels = cp.asarray(imgpixels)
-        imgivar = cp.asarray(imgivar)
-        cp.cuda.nvtx.RangePop()
+        #- Stage through pinned memory (or managed memory for very large
+        #- images) so the copy is asynchronous and can overlap with the setup
+        #- and PSF spot evaluation below
+        #- The two uploads go on separate streams so that they overlap
+        xfer_streams = [cp.cuda.Stream(non_blocking=True) for i in range(2)]
+        imgpixels, pinned_pixels = _to_device(imgpixels, xfer_streams[0])
+        imgivar, pinned_ivar = _to_device(imgivar, xfer_streams[1])
+        nvtx_range_pop()
 
     timer.split('distributed data')
 
@@ -381,66 +647,144 @@ def extract_frame(img, psf, bundlesize, specmin, nspec, wavelength=None, nwavest
     #- TODO: calculate this instead of hardcoding it
     wavepad = 10
 
-    #- Wavelength range that we want to extract
-    wave = np.arange(wmin, wmax + 0.5*dw, dw)
+    fullwave, wave = get_wavelength_grid(wmin, wmax, dw, wavepad, nwavestep)
     nwave = len(wave)
-    
-    #- Pad that with buffer wavelengths to extract and discard, including an
-    #- extra args.nwavestep bins to allow coverage for a final partial bin
-    wavelo = np.arange(wavepad)*dw
-    wavelo -= (np.max(wavelo)+dw)
-    wavelo += wmin
-    wavehi = wave[-1] + (1.0+np.arange(wavepad+nwavestep))*dw
-    
-    fullwave = np.concatenate((wavelo, wave, wavehi))
-    assert np.allclose(np.diff(fullwave), dw)
+
+    #- Wavelength bin width to convert flux to photons/A instead of photons/bin;
+    #- the grid is uniform so this is a scalar
+    dwave = dw
     
     #- TODO: barycentric wavelength corrections
 
     #- Work bundle by bundle
+    bspecmins = list(range(specmin, specmin+nspec, bundlesize))
     if frame_comm is None:
-        bundle_start = 0
-        bundle_step = 1
+        rankbspecmins = bspecmins
     else:
-        bundle_start = device_id
-        bundle_step = device_count
-    bspecmins = list(range(specmin, specmin+nspec, bundlesize))
+        #- Contiguous blocks of bundles per device so that each device
+        #- extracts a single range of spectra
+        rankbspecmins = np.array_split(bspecmins, device_count)[device_id].tolist()
+
+    #- Run the extraction on a dedicated compute stream and copy results back
+    #- on a separate copy stream. The compute stream is a blocking stream so
+    #- that it stays ordered with the numba PSF spot kernels, which are launched
+    #- on the legacy default stream.
+    if gpu:
+        prev_stream = cp.cuda.get_current_stream()
+        compute_stream = cp.cuda.Stream()
+        compute_stream.use()
+
+    #- On the GPU, evaluate the PSF spots once for all of this rank's spectra
+    #- and slice them per bundle instead of reallocating them every bundle
+    if gpu and len(rankbspecmins) > 0:
+        get_spots = _backends['gpu'].get_spots
+        nvtx_range_push('get_spots')
+        rankspecmin = rankbspecmins[0]
+        ranknspec = rankbspecmins[-1] + bundlesize - rankspecmin
+        rankspots, rankcorners = get_spots(rankspecmin, ranknspec, fullwave, psf)
+        nvtx_range_pop()
+
+        #- Compile the extraction kernels while the image is still in flight
+        nvtx_range_push('warmup ex2d_padded')
+        _warmup_ex2d_padded(rankspots[:bundlesize], tuple(c[:bundlesize] for c in rankcorners),
+                            bundlesize // nsubbundles, nwavestep, wavepad, bundlesize)
+        nvtx_range_pop()
+
+    #- Image must be on the device before the first extraction
+    if gpu:
+        for xfer_stream in xfer_streams:
+            compute_stream.wait_event(xfer_stream.record())
+
+    #- Without a bundle comm (or with a CUDA-aware MPI one), bundles are
+    #- assembled and finalized on the device; copy them back asynchronously
+    #- into pinned host buffers so that the transfer of one bundle overlaps the
+    #- extraction of the next
+    device_bundles = gpu and (bundle_comm is None or
+                              (_CUDA_AWARE_MPI and bundle_comm.rank == 0))
+    if device_bundles:
+        ndiag = psf['PSF'].meta['HSIZEY']
+        nrankbundles = len(rankbspecmins)
+        copy_stream = cp.cuda.Stream(non_blocking=True)
+        hostfluxivar = _pinned_empty((nrankbundles, 2, bundlesize, nwave))
+        hostRdiags = _pinned_empty((nrankbundles, bundlesize, 2*ndiag+1, nwave), dtype=np.float32)
+        hostmask = _pinned_empty((nrankbundles, bundlesize, nwave), dtype=np.uint8)
+        #- device results must stay allocated until their copies complete
+        devicebundles = list()
+
     bundles = list()
-    for bspecmin in bspecmins[bundle_start::bundle_step]:
+    for bspecmin in rankbspecmins:
         log.info(f'Rank {rank}: Extracting spectra [{bspecmin}:{bspecmin+bundlesize}]')
         sys.stdout.flush()
+        spots = corners = None
         if gpu:
-            cp.cuda.nvtx.RangePush('extract_bundle')
+            nvtx_range_push('extract_bundle')
+            i0 = bspecmin - rankspecmin
+            spots = rankspots[i0:i0+bundlesize]
+            corners = tuple(c[i0:i0+bundlesize] for c in rankcorners)
         bundle = extract_bundle(
             imgpixels, imgivar, psf,
             wave, fullwave, bspecmin,
             bundlesize=bundlesize, nsubbundles=nsubbundles,
             nwavestep=nwavestep, wavepad=wavepad,
             comm=bundle_comm,
-            gpu=gpu
+            gpu=gpu,
+            spots=spots, corners=corners,
         )
         if gpu:
-            cp.cuda.nvtx.RangePop()
+            nvtx_range_pop()
+            if device_bundles:
+                nvtx_range_push('copy bundle results to host')
+                log.info(f'Rank {rank}: Moving bundle {bspecmin} to host from device {device_id}')
+                #- Convert to photons/A and compute the mask before the copy;
+                #- flux and ivar are written to one array to copy them together
+                flux, ivar, Rdiags = bundle
+                fluxivar = cp.empty((2,) + flux.shape)
+                mask = cp.empty(ivar.shape, dtype=cp.uint8)
+                _finalize_bundle(flux, ivar, 1.0/dwave, dwave*dwave,
+                                 fluxivar[0], fluxivar[1], mask)
+                devicebundle = (fluxivar, Rdiags, mask)
+                i = len(bundles)
+                copy_stream.wait_event(compute_stream.record())
+                hostbundle = (hostfluxivar[i], hostRdiags[i], hostmask[i])
+                for x, out in zip(devicebundle, hostbundle):
+                    x.get(stream=copy_stream, out=out)
+                devicebundles.append(devicebundle)
+                bundle = (hostfluxivar[i, 0], hostfluxivar[i, 1], hostRdiags[i], hostmask[i])
+                nvtx_range_pop()
         bundles.append((bspecmin, bundle))
 
         #- for good measure, have other ranks wait for rank 0
         if bundle_comm is not None:
             bundle_comm.barrier()
 
+    if gpu:
+        prev_stream.use()
+        for xfer_stream in xfer_streams:
+            xfer_stream.synchronize()
+        del pinned_pixels, pinned_ivar
+
+    #- Wait for bundle results to arrive on the host
+    if device_bundles:
+        copy_stream.synchronize()
+        del devicebundles
+
+    #- Release the shared image memory
+    del imgpixels, imgivar
+    for win in imgwins:
+        win.Free()
+
     timer.split('extracted bundles')
 
     if frame_comm is not None:
         # gather results from multiple mpi groups
         if bundle_rank == 0:
             bspecmins, bundles = zip(*bundles)
-            flux, ivar, resolution = zip(*bundles)
+            #- gather each bundle component (flux, ivar, resolution[, mask])
+            columns = [gather_ndarray(column, frame_comm) for column in zip(*bundles)]
             bspecmins = frame_comm.gather(bspecmins, root=0)
-            flux = gather_ndarray(flux, frame_comm)
-            ivar = gather_ndarray(ivar, frame_comm)
-            resolution = gather_ndarray(resolution, frame_comm)
             if rank == 0:
-                bspecmin = [bspecmin for rankbspecmins in bspecmins for bspecmin in rankbspecmins]
-                rankbundles = [list(zip(bspecmin, zip(flux, ivar, resolution))), ]
+                bspecmin = list(itertools.chain.from_iterable(bspecmins))
+                rankbundles = [list(zip(bspecmin, zip(*columns))), ]
     else:
         # no mpi or single group with all ranks
         rankbundles = [bundles,]
@@ -452,26 +796,41 @@ def extract_frame(img, psf, bundlesize, specmin, nspec, wavelength=None, nwavest
     if rank == 0:
 
         #- flatten list of lists into single list
-        allbundles = list()
-        for rb in rankbundles:
-            allbundles.extend(rb)
+        allbundles = list(itertools.chain.from_iterable(rankbundles))
 
         allbundles.sort(key=lambda x: x[0])
 
-        specflux = np.vstack([b[1][0] for b in allbundles])
-        specivar = np.vstack([b[1][1] for b in allbundles])
-        Rdiags = np.vstack([b[1][2] for b in allbundles])
+        #- Allocate output arrays once and copy each bundle into its slice
+        nspecout = len(allbundles)*bundlesize
+        ndiagout = allbundles[0][1][2].shape[1]
+        specflux = np.empty((nspecout, nwave))
+        specivar = np.empty((nspecout, nwave))
+        Rdiags = np.empty((nspecout, ndiagout, nwave), dtype=np.float32)
+        specmask = np.empty((nspecout, nwave), dtype=np.uint8)
+        def copy_bundle(i):
+            bundle = allbundles[i][1]
+            bslice = np.s_[i*bundlesize:(i+1)*bundlesize]
+            np.copyto(Rdiags[bslice], bundle[2])
+            if device_bundles:
+                np.copyto(specflux[bslice], bundle[0])
+                np.copyto(specivar[bslice], bundle[1])
+                np.copyto(specmask[bslice], bundle[3])
+            else:
+                #- Convert flux to photons/A instead of photons/bin and
+                #- compute the mask as part of the copy
+                np.divide(bundle[0], dwave, out=specflux[bslice])
+                np.multiply(bundle[1], dwave*dwave, out=specivar[bslice])
+                np.equal(specivar[bslice], 0, out=specmask[bslice])
 
-        timer.split(f'combined data')
+        #- numpy releases the GIL while copying, so copy bundles in parallel
+        nthreads = max(1, min(len(allbundles), (os.cpu_count() or 1) // 2))
+        with concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+            list(executor.map(copy_bundle, range(len(allbundles))))
 
-        #- Convert flux to photons/A instead of photons/bin
-        dwave = np.gradient(wave)
-        specflux /= dwave
-        specivar *= dwave**2
+        timer.split(f'combined data')
 
-        #- TODO: specmask and chi2pix
-        specmask = (specivar == 0).astype(np.int)
-        chi2pix = np.ones(specflux.shape)
+        #- TODO: chi2pix
+        chi2pix = np.ones(specflux.shape, dtype=np.float32)
 
         frame = dict(
             specflux = specflux,
@@ -479,7 +838,7 @@ def extract_frame(img, psf, bundlesize, specmin, nspec, wavelength=None, nwavest
             specmask = specmask,
             wave = wave,
             Rdiags = Rdiags,
-            chi2pix = np.ones(specflux.shape),
+            chi2pix = chi2pix,
             imagehdr = img['imagehdr'],
             fibermap = img['fibermap'],
             fibermaphdr =  img['fibermaphdr'],
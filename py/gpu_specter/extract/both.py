@@ -7,15 +7,16 @@ import numpy as np
 
 from ..util import Timer
 from ..util import get_array_module
+from ..util import nvtx_range_push, nvtx_range_pop
 from .cpu import get_spec_padding
 
 def safe_range_push(xp, name):
-    if xp.__name__ == 'cupy':
-        xp.cuda.nvtx.RangePush(name)
+    if xp is not np:
+        nvtx_range_push(name)
 
 def safe_range_pop(xp):
-    if xp.__name__ == 'cupy':
-        xp.cuda.nvtx.RangePop()
+    if xp is not np:
+        nvtx_range_pop()
 
 def xp_deconvolve(pixel_values, pixel_ivar, A, debug=False):
     """Calculate the weighted linear least-squares flux solution for an observed trace.
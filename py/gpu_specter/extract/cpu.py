@@ -317,7 +317,7 @@ def get_spec_padding(ispec, nspec, bundlesize):
     return specmin, nspecpad
 
 def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
-                wavepad, bundlesize=25):
+                wavepad, bundlesize=25, out=None):
     """
     Extracted a patch with border padding, but only return results for patch
 
@@ -334,6 +334,10 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
 
     Options:
         bundlesize: size of fiber bundles; padding not needed on their edges
+        out: optional dict of flux[nspec, nwave], ivar[nspec, nwave], and
+            Rdiags[nspec, 2*ndiag+1, nwave] arrays to write the results into
+
+    Returns dict of flux, ivar, and Rdiags results (`out` if provided)
     """
 
     specmin, nspecpad = get_spec_padding(ispec, nspec, bundlesize)
@@ -363,7 +367,13 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
 
     #- Diagonals of R in a form suited for creating scipy.sparse.dia_matrix
     ndiag = spots.shape[2]//2
-    Rdiags = np.zeros( (nspec, 2*ndiag+1, nwave) )
+    if out is None:
+        out = dict(
+            flux = np.empty((nspec, nwave)),
+            ivar = np.empty((nspec, nwave)),
+            Rdiags = np.empty((nspec, 2*ndiag+1, nwave), dtype=np.float32),
+        )
+    specflux, specivar, Rdiags = out['flux'], out['ivar'], out['Rdiags']
 
     if (0 <= ymin) & (ymin+ny < image.shape[0]):
         xyslice = np.s_[ymin:ymin+ny, xmin:xmin+nx]
@@ -371,8 +381,8 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
 
         #- Select the non-padded spectra x wavelength core region
         specslice = np.s_[ispec-specmin:ispec-specmin+nspec,wavepad:wavepad+nwave]
-        specflux = fx[specslice]
-        specivar = ivarfx[specslice]
+        specflux[:] = fx[specslice]
+        specivar[:] = ivarfx[specslice]
 
         #- TODO: check indexing
         i0 = ispec-specmin
@@ -389,17 +399,50 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
     else:
         #- TODO: this zeros out the entire patch if any of it is off the edge
         #- of the image; we can do better than that
-        specflux = np.zeros((nspec, nwave))
-        specivar = np.zeros((nspec, nwave))
+        specflux[:] = 0
+        specivar[:] = 0
+        Rdiags[:] = 0
 
     #- TODO: add chi2pix, pixmask_fraction, optionally modelimage; see specter
-    result = dict(
-        flux = specflux,
-        ivar = specivar,
-        Rdiags = Rdiags,
+    return out
+
+def ex2d_padded_batched(image, imageivar, ispec, iwave, nspec, nwave, spots, corners,
+                        wavepad, bundlesize=25):
+    """
+    Extract a batch of equally sized patches with border padding
+
+    Args:
+        image: full image (not trimmed to a particular xy range)
+        imageivar: image inverse variance (same dimensions as image)
+        ispec: array[npatch] of starting spectrum indices relative to `spots` indexing
+        iwave: array[npatch] of starting wavelength indices
+        nspec: number of spectra to extract per patch (not including padding)
+        nwave: number of wavelengths to extract per patch (not including padding)
+        spots: array[nspec, nwave, ny, nx] pre-evaluated PSF spots
+        corners: tuple of arrays xcorners[nspec, nwave], ycorners[nspec, nwave]
+        wavepad: number of extra wave bins to extract (and discard) on each end
+
+    Options:
+        bundlesize: size of fiber bundles; padding not needed on their edges
+
+    Returns dict of stacked patch results flux[npatch, nspec, nwave],
+    ivar[npatch, nspec, nwave], and Rdiags[npatch, nspec, 2*ndiag+1, nwave]
+    """
+    npatch = len(ispec)
+    ndiag = spots.shape[2]//2
+    #- Preallocate outputs so results are contiguous for assembly and gathering
+    results = dict(
+        flux = np.empty((npatch, nspec, nwave)),
+        ivar = np.empty((npatch, nspec, nwave)),
+        Rdiags = np.empty((npatch, nspec, 2*ndiag+1, nwave), dtype=np.float32),
     )
+    for i in range(npatch):
+        ex2d_padded(image, imageivar,
+                    int(ispec[i]), nspec, int(iwave[i]), nwave,
+                    spots, corners, wavepad, bundlesize=bundlesize,
+                    out={key: value[i] for key, value in results.items()})
 
-    return result
+    return results
 
 #- Simplest form of A.T.dot( Diag(w).dot(A) )
 def dotdot1(A, w):
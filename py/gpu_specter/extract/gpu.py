@@ -13,6 +13,7 @@ from numba import cuda
 
 from ..io import native_endian
 from ..util import Timer
+from ..util import nvtx_range_push, nvtx_range_pop
 
 import numpy.polynomial.legendre
 
@@ -302,7 +303,8 @@ def get_xyrange(ispec, nspec, iwave, nwave, spots, corners):
         iwave: starting wavelength index
         nwave: number of wavelengths
         spots: 4D array[ispec, iwave, ny, nx] of PSF spots
-        corners: (xc,yc) where each is 2D array[ispec,iwave] lower left corner of spot
+        corners: (xc,yc) where each is 2D array[ispec,iwave] lower left corner of spot;
+            these may be device or host arrays
 
     Returns (xmin, xmax, ymin, ymax)
 
@@ -310,9 +312,9 @@ def get_xyrange(ispec, nspec, iwave, nwave, spots, corners):
     """
     ny, nx = spots.shape[2:4]
 
-    # Note: transfer corners back to host
-    xc = corners[0][ispec:ispec+nspec, iwave:iwave+nwave].get()
-    yc = corners[1][ispec:ispec+nspec, iwave:iwave+nwave].get()
+    # Note: transfer corners back to host (no-op for host corners)
+    xc = cp.asnumpy(corners[0][ispec:ispec+nspec, iwave:iwave+nwave])
+    yc = cp.asnumpy(corners[1][ispec:ispec+nspec, iwave:iwave+nwave])
 
     xmin = np.min(xc)
     xmax = np.max(xc) + nx
@@ -321,7 +323,15 @@ def get_xyrange(ispec, nspec, iwave, nwave, spots, corners):
 
     return xmin, xmax, ymin, ymax
 
-def projection_matrix(ispec, nspec, iwave, nwave, spots, corners):
+def _current_numba_stream():
+    '''
+    Returns the current cupy stream as a numba stream so that numba kernels
+    are ordered with the cupy work around them
+    '''
+    ptr = cp.cuda.get_current_stream().ptr
+    return cuda.external_stream(ptr) if ptr else cuda.default_stream()
+
+def projection_matrix(ispec, nspec, iwave, nwave, spots, corners, xyrange=None):
     '''
     Create the projection matrix A for p = Af
 
@@ -333,10 +343,16 @@ def projection_matrix(ispec, nspec, iwave, nwave, spots, corners):
         spots: 4D array[ispec, iwave, ny, nx] of PSF spots
         corners: (xc,yc) where each is 2D array[ispec,iwave] lower left corner of spot
 
+    Options:
+        xyrange: precomputed (xmin, xmax, ymin, ymax) from get_xyrange for
+            these spectra and wavelengths, to avoid transferring corners
+
     Returns (A[iy, ix, ispec, iwave], (xmin, xmax, ymin, ymax))
     '''
     xc, yc = corners
-    xmin, xmax, ymin, ymax = get_xyrange(ispec, nspec, iwave, nwave, spots, corners)
+    if xyrange is None:
+        xyrange = get_xyrange(ispec, nspec, iwave, nwave, spots, corners)
+    xmin, xmax, ymin, ymax = xyrange
     A = cp.zeros((ymax-ymin,xmax-xmin,nspec,nwave), dtype=np.float64)
 
     threads_per_block = (16, 16)
@@ -344,7 +360,7 @@ def projection_matrix(ispec, nspec, iwave, nwave, spots, corners):
     blocks_per_grid_x = math.ceil(A.shape[1] / threads_per_block[1])
     blocks_per_grid = (blocks_per_grid_x, blocks_per_grid_y)
 
-    _cuda_projection_matrix[blocks_per_grid, threads_per_block](
+    _cuda_projection_matrix[blocks_per_grid, threads_per_block, _current_numba_stream()](
         A, xc, yc, xmin, ymin, ispec, iwave, nspec, nwave, spots)
 
     return A, (xmin, xmax, ymin, ymax)
@@ -353,7 +369,7 @@ from .cpu import get_spec_padding
 from .both import xp_ex2d_patch
 
 def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
-                wavepad, bundlesize=25):
+                wavepad, bundlesize=25, out=None, host_corners=None):
     """
     Extracted a patch with border padding, but only return results for patch
 
@@ -370,6 +386,12 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
 
     Options:
         bundlesize: size of fiber bundles; padding not needed on their edges
+        out: optional dict of flux[nspec, nwave], ivar[nspec, nwave], and
+            Rdiags[nspec, 2*ndiag+1, nwave] arrays to write the results into
+        host_corners: optional host copy of corners, used to find the xy
+            ranges of the patch without a blocking device to host transfer
+
+    Returns dict of flux, ivar, and Rdiags results (`out` if provided)
     """
     # timer = Timer()
 
@@ -378,22 +400,27 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
     #- Total number of wavelengths to be extracted, including padding
     nwavetot = nwave+2*wavepad
 
+    #- Corners used to find the xy ranges covered by the patch
+    xycorners = corners if host_corners is None else host_corners
+
     # timer.split('init')
 
     #- Get the projection matrix for the full wavelength range with padding
-    cp.cuda.nvtx.RangePush('projection_matrix')
+    nvtx_range_push('projection_matrix')
+    xyrange = get_xyrange(specmin, nspecpad,
+        iwave-wavepad, nwave+2*wavepad, spots, xycorners)
     A4, xyrange = projection_matrix(specmin, nspecpad,
-        iwave-wavepad, nwave+2*wavepad, spots, corners)
-    cp.cuda.nvtx.RangePop()
+        iwave-wavepad, nwave+2*wavepad, spots, corners, xyrange=xyrange)
+    nvtx_range_pop()
     # timer.split('projection_matrix')
 
     xmin, xmax, ypadmin, ypadmax = xyrange
 
     #- But we only want to use the pixels covered by the original wavelengths
     #- TODO: this unnecessarily also re-calculates xranges
-    cp.cuda.nvtx.RangePush('get_xyrange')
-    xlo, xhi, ymin, ymax = get_xyrange(specmin, nspecpad, iwave, nwave, spots, corners)
-    cp.cuda.nvtx.RangePop()
+    nvtx_range_push('get_xyrange')
+    xlo, xhi, ymin, ymax = get_xyrange(specmin, nspecpad, iwave, nwave, spots, xycorners)
+    nvtx_range_pop()
     # timer.split('get_xyrange')
 
     ypadlo = ymin - ypadmin
@@ -409,29 +436,35 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
 
     #- Diagonals of R in a form suited for creating scipy.sparse.dia_matrix
     ndiag = spots.shape[2]//2
-    cp.cuda.nvtx.RangePush('Rdiags allocation')
-    Rdiags = cp.zeros( (nspec, 2*ndiag+1, nwave) )
-    cp.cuda.nvtx.RangePop()
+    nvtx_range_push('allocate results')
+    if out is None:
+        out = dict(
+            flux = cp.empty((nspec, nwave)),
+            ivar = cp.empty((nspec, nwave)),
+            Rdiags = cp.empty((nspec, 2*ndiag+1, nwave), dtype=cp.float32),
+        )
+    specflux, specivar, Rdiags = out['flux'], out['ivar'], out['Rdiags']
+    nvtx_range_pop()
 
     if (0 <= ymin) & (ymin+ny < image.shape[0]):
         xyslice = np.s_[ymin:ymin+ny, xmin:xmin+nx]
         # timer.split('ready for extraction')
-        cp.cuda.nvtx.RangePush('extract patch')
+        nvtx_range_push('extract patch')
         fx, ivarfx, R = xp_ex2d_patch(image[xyslice], imageivar[xyslice], A4)
-        cp.cuda.nvtx.RangePop()
+        nvtx_range_pop()
         # timer.split('extracted patch')
 
         #- Select the non-padded spectra x wavelength core region
-        cp.cuda.nvtx.RangePush('select slices to keep')
+        nvtx_range_push('select slices to keep')
         specslice = np.s_[ispec-specmin:ispec-specmin+nspec,wavepad:wavepad+nwave]
-        cp.cuda.nvtx.RangePush('slice flux')
-        specflux = fx[specslice]
-        cp.cuda.nvtx.RangePop()
-        cp.cuda.nvtx.RangePush('slice ivar')
-        specivar = ivarfx[specslice]
-        cp.cuda.nvtx.RangePop()
-
-        cp.cuda.nvtx.RangePush('slice R')
+        nvtx_range_push('slice flux')
+        specflux[:] = fx[specslice]
+        nvtx_range_pop()
+        nvtx_range_push('slice ivar')
+        specivar[:] = ivarfx[specslice]
+        nvtx_range_pop()
+
+        nvtx_range_push('slice R')
         mask = (
             ~cp.tri(nwave, nwavetot, (wavepad-ndiag-1), dtype=bool) &
             cp.tri(nwave, nwavetot, (wavepad+ndiag), dtype=bool)
@@ -441,24 +474,77 @@ def ex2d_padded(image, imageivar, ispec, nspec, iwave, nwave, spots, corners,
             ii = slice(nwavetot*i, nwavetot*(i+1))
             Rdiags[i-i0] = R[ii, ii][:,wavepad:-wavepad].T[mask].reshape(nwave, 2*ndiag+1).T
         # timer.split('saved Rdiags')
-        cp.cuda.nvtx.RangePop()
-        cp.cuda.nvtx.RangePop()
+        nvtx_range_pop()
+        nvtx_range_pop()
 
     else:
         #- TODO: this zeros out the entire patch if any of it is off the edge
         #- of the image; we can do better than that
-        specflux = cp.zeros((nspec, nwave))
-        specivar = cp.zeros((nspec, nwave))
+        specflux[:] = 0
+        specivar[:] = 0
+        Rdiags[:] = 0
 
     #- TODO: add chi2pix, pixmask_fraction, optionally modelimage; see specter
-    cp.cuda.nvtx.RangePush('prepare result')
-    result = dict(
-        flux = specflux,
-        ivar = specivar,
-        Rdiags = Rdiags,
-    )
-    cp.cuda.nvtx.RangePop()
     # timer.split('done')
     # timer.print_splits()
 
-    return result
+    return out
+
+
+def ex2d_padded_batched(image, imageivar, ispec, iwave, nspec, nwave, spots, corners,
+                        wavepad, bundlesize=25, nstreams=3):
+    """
+    Extract a batch of equally sized patches with border padding
+
+    Args:
+        image: full image (not trimmed to a particular xy range)
+        imageivar: image inverse variance (same dimensions as image)
+        ispec: array[npatch] of starting spectrum indices relative to `spots` indexing
+        iwave: array[npatch] of starting wavelength indices
+        nspec: number of spectra to extract per patch (not including padding)
+        nwave: number of wavelengths to extract per patch (not including padding)
+        spots: array[nspec, nwave, ny, nx] pre-evaluated PSF spots
+        corners: tuple of arrays xcorners[nspec, nwave], ycorners[nspec, nwave]
+        wavepad: number of extra wave bins to extract (and discard) on each end
+
+    Options:
+        bundlesize: size of fiber bundles; padding not needed on their edges
+        nstreams: number of streams to cycle through so that the extraction
+            of consecutive patches can overlap on the device
+
+    Returns dict of stacked patch results flux[npatch, nspec, nwave],
+    ivar[npatch, nspec, nwave], and Rdiags[npatch, nspec, 2*ndiag+1, nwave]
+
+    The results are ready for use on the stream that was current on entry.
+    """
+    npatch = len(ispec)
+    ndiag = spots.shape[2]//2
+    #- Preallocate outputs so results are contiguous for assembly and gathering
+    results = dict(
+        flux = cp.empty((npatch, nspec, nwave)),
+        ivar = cp.empty((npatch, nspec, nwave)),
+        Rdiags = cp.empty((npatch, nspec, 2*ndiag+1, nwave), dtype=cp.float32),
+    )
+
+    #- Every patch needs its xy range on the host; transfer the corners once
+    #- so that the patch loop below does not block on device to host copies
+    host_corners = (cp.asnumpy(corners[0]), cp.asnumpy(corners[1]))
+
+    #- Patches write disjoint outputs, so they can be extracted on a pool of
+    #- streams that all start after, and finish before, the current stream
+    current_stream = cp.cuda.get_current_stream()
+    ready = current_stream.record()
+    streams = [cp.cuda.Stream(non_blocking=True) for i in range(min(nstreams, npatch))]
+    for stream in streams:
+        stream.wait_event(ready)
+    for i in range(npatch):
+        with streams[i % len(streams)]:
+            ex2d_padded(image, imageivar,
+                        int(ispec[i]), nspec, int(iwave[i]), nwave,
+                        spots, corners, wavepad, bundlesize=bundlesize,
+                        out={key: value[i] for key, value in results.items()},
+                        host_corners=host_corners)
+    for stream in streams:
+        current_stream.wait_event(stream.record())
+
+    return results
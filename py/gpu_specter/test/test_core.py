@@ -0,0 +1,111 @@
+import unittest
+import numpy as np
+
+from gpu_specter.core import Patch, assemble_bundle_patches, get_patch_layout, get_wavelength_grid
+
+class TestCore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bspecmin = 25
+        cls.bundlesize = 10
+        cls.nspectra_per_patch = 5
+        cls.nwavestep = 20
+        cls.wavepad = 4
+        cls.nwave = 55
+        cls.ndiag = 2
+
+    def get_patches(self):
+        patches = list()
+        for ispec in range(self.bspecmin, self.bspecmin+self.bundlesize, self.nspectra_per_patch):
+            for iwave in range(self.wavepad, self.wavepad+self.nwave, self.nwavestep):
+                patches.append(Patch(ispec, iwave, self.bspecmin,
+                                     self.nspectra_per_patch, self.nwavestep, self.wavepad,
+                                     self.nwave, self.bundlesize, self.ndiag))
+        return patches
+
+    def test_patch_layout(self):
+        patches = self.get_patches()
+        ispec, iwave, nwavekeep = get_patch_layout(
+            self.bundlesize, self.nspectra_per_patch, self.nwavestep, self.wavepad, self.nwave)
+        self.assertEqual(len(ispec), len(patches))
+        self.assertEqual(ispec.dtype, np.int32)
+        for i, patch in enumerate(patches):
+            self.assertEqual(ispec[i], patch.ispec - self.bspecmin)
+            self.assertEqual(iwave[i], patch.iwave)
+            self.assertEqual(nwavekeep[i], patch.keepslice.stop)
+
+    def test_wavelength_grid(self):
+        for wmin, wmax, dw in ((5760.0, 7620.0, 0.8), (6000.0, 6110.0, 0.8), (3600.0, 3601.0, 0.5)):
+            fullwave, wave = get_wavelength_grid(wmin, wmax, dw, self.wavepad, self.nwavestep)
+            expected = np.arange(wmin, wmax + 0.5*dw, dw)
+            self.assertEqual(len(wave), len(expected))
+            self.assertTrue(np.allclose(wave, expected))
+            self.assertEqual(len(fullwave), len(wave) + 2*self.wavepad + self.nwavestep)
+            self.assertEqual(fullwave[self.wavepad], wave[0])
+            self.assertTrue(np.allclose(np.diff(fullwave), dw))
+
+    def test_assemble_bundle_patches(self):
+        patches = self.get_patches()
+        nspec, nwave = self.nspectra_per_patch, self.nwavestep
+        ndiag = self.ndiag
+        npatch = len(patches)
+        results = dict(
+            flux = np.random.randn(npatch, nspec, nwave),
+            ivar = np.random.rand(npatch, nspec, nwave),
+            Rdiags = np.random.randn(npatch, nspec, 2*ndiag+1, nwave).astype(np.float32),
+        )
+
+        #- split results between two "ranks"
+        rankresults = list()
+        for rank in range(2):
+            rankresults.append(
+                (patches[rank::2], {key: value[rank::2] for key, value in results.items()})
+            )
+        specflux, specivar, Rdiags = assemble_bundle_patches(rankresults)
+
+        self.assertEqual(specflux.shape, (self.bundlesize, self.nwave))
+        self.assertEqual(specivar.shape, (self.bundlesize, self.nwave))
+        self.assertEqual(Rdiags.shape, (self.bundlesize, 2*ndiag+1, self.nwave))
+        self.assertEqual(Rdiags.dtype, np.float32)
+
+        for i, patch in enumerate(patches):
+            keep = patch.keepslice
+            self.assertTrue(np.all(specflux[patch.specslice, patch.waveslice] == results['flux'][i, :, keep]))
+            self.assertTrue(np.all(specivar[patch.specslice, patch.waveslice] == results['ivar'][i, :, keep]))
+            self.assertTrue(np.all(Rdiags[patch.specslice, :, patch.waveslice] == results['Rdiags'][i, :, :, keep]))
+
+    def test_assemble_dtype(self):
+        patches = self.get_patches()
+        nspec, nwave = self.nspectra_per_patch, self.nwavestep
+        npatch = len(patches)
+        results = dict(
+            flux = np.random.randn(npatch, nspec, nwave),
+            ivar = np.random.rand(npatch, nspec, nwave),
+            Rdiags = np.random.randn(npatch, nspec, 2*self.ndiag+1, nwave),
+        )
+        specflux, specivar, Rdiags = assemble_bundle_patches([(patches, results)], dtype=np.float64)
+        self.assertEqual(Rdiags.dtype, np.float64)
+        for i, patch in enumerate(patches):
+            keep = patch.keepslice
+            self.assertTrue(np.all(Rdiags[patch.specslice, :, patch.waveslice] == results['Rdiags'][i, :, :, keep]))
+
+    def test_assemble_partial_coverage(self):
+        #- outputs not covered by any patch must still be zero
+        patches = self.get_patches()[1:]
+        nspec, nwave = self.nspectra_per_patch, self.nwavestep
+        npatch = len(patches)
+        results = dict(
+            flux = np.ones((npatch, nspec, nwave)),
+            ivar = np.ones((npatch, nspec, nwave)),
+            Rdiags = np.ones((npatch, nspec, 2*self.ndiag+1, nwave), dtype=np.float32),
+        )
+        specflux, specivar, Rdiags = assemble_bundle_patches([(patches, results)])
+        missing = self.get_patches()[0]
+        self.assertTrue(np.all(specflux[missing.specslice, missing.waveslice] == 0))
+        self.assertTrue(np.all(specivar[missing.specslice, missing.waveslice] == 0))
+        self.assertTrue(np.all(Rdiags[missing.specslice, :, missing.waveslice] == 0))
+        self.assertEqual(np.sum(specflux), self.bundlesize*self.nwave - nspec*nwave)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest, os
+from unittest import mock
+import numpy as np
+
+from gpu_specter.util import gather_ndarray, bcast_shared_ndarray, bcast_tables
+
+try:
+    from mpi4py import MPI
+    mpi_available = True
+except ImportError:
+    mpi_available = False
+
+
+@unittest.skipIf(not mpi_available, 'mpi4py not available')
+class TestGatherNdarray(unittest.TestCase):
+
+    def test_ndarray(self):
+        x = np.random.rand(3, 4, 5)
+        y = gather_ndarray(x, MPI.COMM_SELF)
+        self.assertEqual(y.shape, x.shape)
+        self.assertTrue(np.all(y == x))
+
+    def test_noncontiguous(self):
+        x = np.random.rand(3, 4, 10)[:, :, ::2]
+        y = gather_ndarray(x, MPI.COMM_SELF)
+        self.assertTrue(np.all(y == x))
+
+    def test_sequence(self):
+        x = [np.random.rand(4, 5) for i in range(3)]
+        y = gather_ndarray(tuple(x), MPI.COMM_SELF)
+        self.assertEqual(y.shape, (3, 4, 5))
+        self.assertTrue(np.all(y == np.stack(x)))
+
+    def test_chunks(self):
+        x = np.random.rand(3, 4, 5)
+        for nchunks in ('2', '7', '100'):
+            with mock.patch.dict(os.environ, {'GPU_SPECTER_GATHER_CHUNKS': nchunks}):
+                y = gather_ndarray(x, MPI.COMM_SELF)
+            self.assertTrue(np.all(y == x))
+
+    def test_empty(self):
+        y = gather_ndarray([], MPI.COMM_SELF)
+        self.assertEqual(y.size, 0)
+
+
+@unittest.skipIf(not mpi_available, 'mpi4py not available')
+class TestBcastSharedNdarray(unittest.TestCase):
+
+    def test_bcast(self):
+        x = np.random.rand(7, 9)
+        y, win = bcast_shared_ndarray(x, MPI.COMM_SELF)
+        self.assertEqual(y.dtype, x.dtype)
+        self.assertTrue(np.all(y == x))
+        self.assertFalse(y.flags.writeable)
+        del y
+        win.Free()
+
+
+@unittest.skipIf(not mpi_available, 'mpi4py not available')
+class TestBcastTables(unittest.TestCase):
+
+    def test_bcast(self):
+        from astropy.table import Table
+        t = Table(dict(COEFF=np.random.rand(3, 4, 2).astype('>f8'), PARAM=['X', 'Y', 'GH']))
+        t.meta['HSIZEY'] = 5
+        tables = bcast_tables(dict(PSF=t), MPI.COMM_SELF)
+        self.assertEqual(list(tables), ['PSF'])
+        self.assertEqual(tables['PSF'].meta['HSIZEY'], 5)
+        self.assertTrue(np.all(tables['PSF']['COEFF'] == t['COEFF']))
+        self.assertTrue(np.all(tables['PSF']['PARAM'] == t['PARAM']))
+
+if __name__ == '__main__':
+    unittest.main()
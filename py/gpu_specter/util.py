@@ -13,34 +13,190 @@ try:
 except ImportError:
     pass
 
+#- NVTX profiling ranges are only emitted when GPU_SPECTER_NVTX=1, so that
+#- production runs do not pay for a call per range
+if os.getenv('GPU_SPECTER_NVTX', '0') == '1' and 'cp' in globals():
+    nvtx_range_push = cp.cuda.nvtx.RangePush
+    nvtx_range_pop = cp.cuda.nvtx.RangePop
+else:
+    def nvtx_range_push(name):
+        pass
+    def nvtx_range_pop():
+        pass
+
+class NvtxRange(object):
+    def __init__(self, name):
+        """Context manager for an NVTX range (see nvtx_range_push)
+
+        Args:
+            name: name of the range
+        """
+        self.name = name
+
+    def __enter__(self):
+        nvtx_range_push(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        nvtx_range_pop()
+
 def gather_ndarray(sendbuf, comm, root=0):
     """Gather multidimensional ndarray objects to one process from all other processes in a group.
 
     Args:
-        sendbuf: multidimensional ndarray
+        sendbuf: multidimensional ndarray or sequence of equally shaped ndarrays
         comm: mpi communicator
         root: rank of receiving process
     Returns:
         recvbuf: A stacked multidemsional ndarray if comm.rank == root, otherwise None.
 
+    A cupy sendbuf is gathered into a cupy recvbuf directly between device
+    buffers, which requires a CUDA-aware MPI build.
     """
     rank = comm.rank
-    # Save shape and flatten input array
-    sendbuf = np.array(sendbuf)
+    # Save shape and flatten input array, only copying if it is not
+    # already a contiguous ndarray
+    if isinstance(sendbuf, (list, tuple)):
+        # Stack sequences with the module of their elements so that a
+        # sequence of cupy arrays is stacked on the device
+        if len(sendbuf) > 0:
+            xp = get_array_module(sendbuf[0])
+            sendbuf = xp.stack(sendbuf)
+        else:
+            xp = np
+            sendbuf = np.empty((0,))
+    else:
+        xp = get_array_module(sendbuf)
+        sendbuf = xp.ascontiguousarray(sendbuf)
+    if xp is not np:
+        # MPI is not stream aware, so the device data must be ready
+        cp.cuda.get_current_stream().synchronize()
     shape = sendbuf.shape
     sendbuf = sendbuf.ravel()
     # Collect local array sizes using the high-level mpi4py gather
     sendcounts = np.array(comm.gather(len(sendbuf), root))
     if rank == root:
-        recvbuf = np.empty(sum(sendcounts), dtype=sendbuf.dtype)
+        recvbuf = xp.empty(int(sum(sendcounts)), dtype=sendbuf.dtype)
+        displs = np.cumsum(sendcounts) - sendcounts
     else:
         recvbuf = None
-    comm.Gatherv(sendbuf=sendbuf, recvbuf=(recvbuf, sendcounts), root=root)
+    # Some MPI implementations handle several smaller gathers better than a
+    # single large one, so optionally split every rank's buffer into
+    # GPU_SPECTER_GATHER_CHUNKS pieces gathered directly into place
+    nchunks = max(1, int(os.getenv('GPU_SPECTER_GATHER_CHUNKS', '1')))
+    n = len(sendbuf)
+    for k in range(nchunks):
+        if rank == root:
+            lo, hi = k*sendcounts//nchunks, (k+1)*sendcounts//nchunks
+            recvchunk = [recvbuf, (hi - lo, displs + lo)]
+        else:
+            recvchunk = None
+        comm.Gatherv(sendbuf=sendbuf[k*n//nchunks:(k+1)*n//nchunks], recvbuf=recvchunk, root=root)
     if rank == root:
         # Reshape output before returning
         recvbuf = recvbuf.reshape((-1,) + shape[1:])
     return recvbuf
 
+def bcast_shared_ndarray(arr, comm, root=0):
+    """Broadcast an ndarray into node-local MPI shared memory.
+
+    All ranks on a node get a view of a single shared copy of the array, so
+    the array is only sent once to each node instead of once to every rank.
+
+    Args:
+        arr: ndarray to broadcast on the root rank (ignored on other ranks)
+        comm: mpi communicator
+        root: rank that holds the array
+    Returns:
+        (array, win) tuple of the shared, read-only ndarray view and the MPI
+        window holding its memory; the window must be kept alive while the
+        array is in use and then released with win.Free(), which is collective
+        over the ranks of the node.
+
+    Requires MPI-3 shared memory windows (see mpi4py.MPI.Get_version()).
+    """
+    from mpi4py import MPI
+    rank = comm.rank
+    # Order root first so that it leads both its node and the node leaders
+    key = 0 if rank == root else 1
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=key)
+    leader = node_comm.rank == 0
+    leader_comm = comm.Split(0 if leader else MPI.UNDEFINED, key=key)
+
+    if rank == root:
+        shape, dtype = arr.shape, arr.dtype.str
+    else:
+        shape = dtype = None
+    shape, dtype = comm.bcast((shape, dtype), root=root)
+    dtype = np.dtype(dtype)
+
+    # Only the node leader allocates, the other ranks attach to its memory
+    nbytes = int(np.prod(shape)) * dtype.itemsize if leader else 0
+    win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+    buf, itemsize = win.Shared_query(0)
+    shared = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+
+    if rank == root:
+        shared[...] = arr
+    if leader:
+        leader_comm.Bcast(shared, root=0)
+        leader_comm.Free()
+    node_comm.Barrier()
+    node_comm.Free()
+
+    shared.flags.writeable = False
+    return shared, win
+
+def bcast_tables(tables, comm, root=0):
+    """Broadcast a dictionary of astropy Tables, such as a psf (see gpu_specter.io.read_psf).
+
+    Only the small table and column metadata are pickled; the column data
+    are sent with buffer-based Bcast calls, avoiding pickling and unpickling
+    large arrays on every rank.
+
+    Args:
+        tables: dictionary of astropy Tables on the root rank (ignored on other ranks)
+        comm: mpi communicator
+        root: rank that holds the tables
+    Returns:
+        tables: dictionary of astropy Tables (the input tables on the root rank)
+    """
+    from mpi4py import MPI
+    from astropy.table import Table, Column
+    rank = comm.rank
+    if rank == root:
+        layout = dict()
+        for name, table in tables.items():
+            columns = list()
+            for colname in table.colnames:
+                col = table[colname]
+                columns.append((colname, col.shape, col.dtype.str,
+                                dict(unit=col.unit, description=col.description,
+                                     format=col.format, meta=col.meta)))
+            layout[name] = (table.meta, columns)
+    else:
+        layout = None
+    layout = comm.bcast(layout, root=root)
+
+    if rank != root:
+        tables = dict()
+    for name, (meta, columns) in layout.items():
+        cols = list()
+        for colname, shape, dtype, info in columns:
+            if rank == root:
+                data = np.ascontiguousarray(tables[name][colname])
+            else:
+                data = np.empty(shape, dtype=dtype)
+            # Send raw bytes so any dtype (e.g. big-endian FITS data or
+            # fixed-width strings) is transferred as-is
+            comm.Bcast([data, MPI.BYTE], root=root)
+            if rank != root:
+                cols.append(Column(data, name=colname, copy=False, **info))
+        if rank != root:
+            tables[name] = Table(cols, meta=meta, copy=False)
+
+    return tables
+
 def get_array_module(x):
     """Returns the array module for arguments.
 
@@ -5,6 +5,9 @@ export PYTHONPATH=$(pwd)/py:$PYTHONPATH
 
 export OMP_NUM_THREADS=1
 
+#- Keep the cupy kernel cache on node-local storage instead of $HOME
+export CUPY_CACHE_DIR=${CUPY_CACHE_DIR:-${TMPDIR:-/tmp}/cupy-cache-$USER}
+
 #run command
 #srun -n 32 -c 2 spex --mpi -w 5760.0,7620.0,0.8 -i data/preproc-r0-00051060.fits -p data/psf-r0-00051060.fits -o $SCRATCH/frame-r0-00051060.fits
 